@@ -4,25 +4,59 @@ import asyncio
 import threading
 import logging
 import json
-from typing import List, Dict, TypedDict
+import time
+from collections import Counter
+from typing import Callable, List, Dict, Optional, Tuple, TypedDict
 from contextlib import AsyncExitStack
-from queue import Queue
-from anthropic import Anthropic
+import anyio
+from anthropic import AsyncAnthropic
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # optional: stdlib json is the fallback
+    orjson = None
+
 load_dotenv()
 
 # ---------- Logging ----------
 logging.basicConfig(
     level=logging.ERROR,  # change to INFO/DEBUG when you want more trace
-    # level=logging.INFO,  # change to INFO/DEBUG when you want more trace
     format="%(asctime)s [%(levelname)s] [%(threadName)s] %(message)s",
 )
+# Log calls pass raw objects with %.Ns specs, so nothing is stringified unless a handler emits
 log = logging.getLogger(__name__)
 
 
+# ---------- JSON ----------
+def _dumps(obj, sort_keys: bool = False) -> str:
+    """Serialize obj to a JSON string (orjson when available; non-JSON values via str)."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+    return json.dumps(obj, sort_keys=sort_keys, default=str)
+
+
+# ---------- MCP connection errors ----------
+_TRANSPORT_ERRORS = (
+    BrokenPipeError,
+    ConnectionError,
+    anyio.ClosedResourceError,
+    anyio.BrokenResourceError,
+    anyio.EndOfStream,
+)
+
+
+def _is_connection_lost(exc: BaseException) -> bool:
+    """True if exc means the server's stdio connection is gone (vs. an ordinary tool error)."""
+    if isinstance(exc, McpError):
+        return exc.error.code == CONNECTION_CLOSED
+    return isinstance(exc, _TRANSPORT_ERRORS)
+
+
 # ---------- Types ----------
 class ToolDefinition(TypedDict):
     name: str
@@ -30,258 +64,751 @@ class ToolDefinition(TypedDict):
     input_schema: dict
 
 
+# ---------- Model / tool loop ----------
+MODEL_NAME = 'claude-3-7-sonnet-20250219'
+SUMMARY_MODEL_NAME = 'claude-3-5-haiku-latest'  # final write-up once MAX_TOOL_LOOPS is hit
+MAX_TOOL_LOOPS = 6
+MAX_SEARCHES_PER_QUERY = 2  # further search_drugs calls get an error tool_result
+
+
+# ---------- Tool result cache ----------
+TOOL_CACHE_TTL_S = 300.0       # identical (tool, args) calls reuse the result this long
+TOOL_CACHE_MAX_ENTRIES = 256
+UNCACHED_TOOLS: set = set()    # tools whose results must never be reused (e.g. mutations)
+
+# Servers that expose this tool accept several tool calls in one request;
+# it is client plumbing and never offered to the model.
+BATCH_TOOL = "batch_execute"
+
+
+def _is_error_reply(text: str) -> bool:
+    """
+    True if a tool's reply text reports a failure: a JSON object with a top-level "error"
+    key, or a batch whose per-entry "results" include one.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return False
+    if not isinstance(data, dict):
+        return False
+    if "error" in data:
+        return True
+    results = data.get("results")
+    entries = results.values() if isinstance(results, dict) else results if isinstance(results, list) else ()
+    return any(isinstance(e, dict) and "error" in e for e in entries)
+
+
+# ---------- Tool result trimming ----------
+TRIM_SEARCH_ROWS = 8  # search_drugs rows kept in the history
+# RxNorm property fields the model actually uses; the rest (language, suppress, umlscui) is noise
+DRUG_PROPERTY_FIELDS = ("rxcui", "name", "synonym", "tty")
+
+
+def _slim_properties(props: Dict) -> Dict:
+    return {k: props[k] for k in DRUG_PROPERTY_FIELDS if props.get(k)}
+
+
+def _trim_tool_result(tool_name: str, text: str) -> str:
+    """
+    Shrink a high-volume tool result to the fields the model needs before it joins the
+    history (every later call in the session re-sends it). Unknown tools, errors and
+    non-JSON text pass through unchanged.
+    """
+    if tool_name not in ("search_drugs", "get_drug_properties", "get_drug_properties_batch"):
+        return text
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return text
+    if not isinstance(data, dict):
+        return text
+    if tool_name == "search_drugs" and isinstance(data.get("results"), list):
+        rows = data["results"]
+        data["results"] = [
+            {k: v for k, v in row.items() if v}
+            for row in rows[:TRIM_SEARCH_ROWS] if isinstance(row, dict)
+        ]
+        if len(rows) > TRIM_SEARCH_ROWS:
+            data["omitted"] = len(rows) - TRIM_SEARCH_ROWS
+    elif tool_name == "get_drug_properties" and isinstance(data.get("properties"), dict):
+        data["properties"] = _slim_properties(data["properties"])
+    elif tool_name == "get_drug_properties_batch" and isinstance(data.get("results"), dict):
+        data["results"] = {
+            rx: props if "error" in props else _slim_properties(props)
+            for rx, props in data["results"].items() if isinstance(props, dict)
+        }
+    else:
+        return text
+    return _dumps(data)  # compact JSON: no pretty-print whitespace in the prompt
+
+
+# ---------- Memory compaction ----------
+COMPACT_AFTER_MESSAGES = 20   # compact once a session's memory grows past this
+KEEP_RECENT_TURNS = 6         # completed query turns always kept verbatim
+MAX_GIST_LINES = 40           # cap on the compacted-history summary itself
+COMPACTED_PREFIX = "<compacted history>"
+GIST_OMITTED_NOTE = "(older turns omitted)"  # gist header line once whole turns were dropped
+
+
+def _field(block, key: str):
+    """Read a content-block field whether it's a plain dict or an SDK object."""
+    return block.get(key) if isinstance(block, dict) else getattr(block, key, None)
+
+
+def _with_cache_breakpoint(messages: List[Dict]) -> List[Dict]:
+    """
+    Request copy of messages with a prompt-cache breakpoint on the last content block.
+    The tool loop resends the whole history every iteration, so the next iteration reads
+    everything up to here from cache. The stored memory is left unmarked: one breakpoint
+    per request, never accumulating past the API's limit of 4.
+    """
+    if not messages:
+        return messages
+    *head, last = messages
+    content = last['content']
+    if isinstance(content, str):
+        content = [{'type': 'text', 'text': content}]
+    if not content or not isinstance(content[-1], dict):
+        return messages
+    marked = [*content[:-1], {**content[-1], 'cache_control': {'type': 'ephemeral'}}]
+    return [*head, {**last, 'content': marked}]
+
+
+def _clip(text, n: int) -> str:
+    """Single-line, length-capped version of text for gists."""
+    text = " ".join(str(text or "").split())
+    return text if len(text) <= n else text[: n - 1] + "…"
+
+
 # ---------- Chatbot ----------
 class MCP_ChatBot:
     def __init__(self):
         self.sessions: List[ClientSession] = []
-        self.exit_stack = AsyncExitStack()
-        self.anthropic = Anthropic()
+        # server name -> {'params', 'session', 'tool_names', 'tool_defs', 'stop', 'task', 'lock'}
+        self.servers: Dict[str, Dict] = {}
+        self._anthropic: Optional[AsyncAnthropic] = None  # see the anthropic property
         self.available_tools: List[ToolDefinition] = []
+        # Frozen, request-ready tools list; built once after connecting
+        self._tools_request: Tuple[Dict, ...] = ()
         self.tool_to_session: Dict[str, ClientSession] = {}
-        # Persistent conversation memory (Anthropic-compliant turns only)
-        # Each item is {'role': 'user'|'assistant', 'content': <str|list[blocks]>}
-        self.messages: List[Dict] = []
+        self._batch_sessions: List[ClientSession] = []  # sessions advertising BATCH_TOOL
+        # Set once connecting has finished and the tool list is final (even if it failed)
+        self.ready_event = asyncio.Event()
+        self.connect_error: Optional[str] = None  # why connecting failed, if it did
+        # (tool_name, canonical args JSON) -> (stored_at, result_text); shared by all sessions
+        self._tool_cache: Dict[str, Tuple[float, str]] = {}
+
+    @property
+    def anthropic(self) -> AsyncAnthropic:
+        """
+        Async client (model round-trips must not block the event loop serving tool calls/users).
+        Created on first use, so constructing the bot at import time has no side effects; NiceGUI's
+        native window process re-imports frontend.py as __mp_main__ and never makes a call.
+        """
+        if self._anthropic is None:
+            self._anthropic = AsyncAnthropic()
+        return self._anthropic
 
     # ----- Server connections -----
     async def connect_to_servers(self):
-        """Load server_config.json and connect to each MCP server once."""
+        """
+        Load server_config.json and connect to each MCP server once.
+        ready_event is set however this ends; on failure connect_error says why.
+        """
         log.info("connect_to_servers: start")
-        with open("server_config.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-
-        servers = data.get("mcpServers", {})
-        for name, config in servers.items():
-            await self.connect_to_server(name, config)
-
-        log.info(
-            "connect_to_servers: done; sessions=%d tools=%d",
-            len(self.sessions), len(self.available_tools)
-        )
+        try:
+            with open("server_config.json", "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            servers = data.get("mcpServers", {})
+            # Spawn + handshake every server at once: startup costs ~max(handshake), not the sum
+            outcomes = await asyncio.gather(
+                *[self.connect_to_server(name, cfg) for name, cfg in servers.items()],
+                return_exceptions=True,
+            )
+            for name, outcome in zip(servers, outcomes):
+                if isinstance(outcome, BaseException):
+                    log.error("connect_to_server(%s) failed: %r", name, outcome)
+
+            # Merge per-server results in config order, so the tools prefix of every request is stable
+            for name in servers:
+                entry = self.servers.get(name)
+                if entry is None:
+                    continue
+                self.sessions.append(entry["session"])
+                self.available_tools.extend(entry["tool_defs"])
+            if not self.sessions:
+                self.connect_error = "no MCP server could be started"
+        except Exception as e:
+            self.connect_error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            # The tool set is fixed from here on: freeze it and build the request payload once
+            # instead of on every tool-loop iteration. Always signal, so waiters never hang.
+            self.available_tools = tuple(self.available_tools)
+            self._tools_request = self._build_tools_request()
+            self.ready_event.set()
+            log.info(
+                "connect_to_servers: done; sessions=%d tools=%d error=%s",
+                len(self.sessions), len(self.available_tools), self.connect_error
+            )
 
     async def connect_to_server(self, server_name: str, server_config: dict) -> None:
         """Connect to a single MCP server, list tools, and cache them."""
         log.info("connect_to_server(%s): start", server_name)
         server_params = StdioServerParameters(**server_config)
-        stdio_transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
-        read, write = stdio_transport
-        session = await self.exit_stack.enter_async_context(ClientSession(read, write))
-        await session.initialize()
-        self.sessions.append(session)
+        session, stop, task = await self._launch_server(server_params)
 
-        tools = (await session.list_tools()).tools
+        # Collected per server and merged by connect_to_servers (servers connect concurrently)
+        tool_defs: List[ToolDefinition] = []
+        try:
+            tools = (await session.list_tools()).tools
+        except Exception:
+            stop.set()  # not registered yet, so close() wouldn't reach this server
+            raise
         for tool in tools:
+            if tool.name == BATCH_TOOL:
+                self._batch_sessions.append(session)
+                continue
             self.tool_to_session[tool.name] = session
-            self.available_tools.append({
+            tool_defs.append({
                 "name": tool.name,
                 "description": tool.description,
                 "input_schema": tool.inputSchema,
             })
-        log.info(
-            "connect_to_server(%s): initialized; tools=%s",
-            server_name, [t["name"] for t in self.available_tools]
-        )
+        tool_names = [t["name"] for t in tool_defs]
+        self.servers[server_name] = {
+            "params": server_params,
+            "session": session,
+            "tool_names": tool_names,
+            "tool_defs": tool_defs,
+            "stop": stop,
+            "task": task,
+            "lock": asyncio.Lock(),
+        }
+        log.info("connect_to_server(%s): initialized; tools=%s", server_name, tool_names)
+
+    async def _launch_server(self, params: StdioServerParameters):
+        """
+        Spawn a server + MCP session inside its own owner task and wait for the handshake.
+        The owner task both enters and exits the stdio/session contexts (anyio cancel scopes
+        must close in the task that opened them), so one server can be relaunched or shut
+        down independently. Returns (session, stop_event, owner_task); set stop_event to close.
+        """
+        started: asyncio.Future = asyncio.get_running_loop().create_future()
+        stop = asyncio.Event()
+
+        async def own():
+            try:
+                async with AsyncExitStack() as stack:
+                    read, write = await stack.enter_async_context(stdio_client(params))
+                    session = await stack.enter_async_context(ClientSession(read, write))
+                    await session.initialize()
+                    started.set_result(session)
+                    await stop.wait()
+            except Exception as e:
+                if not started.done():
+                    started.set_exception(e)
+                else:
+                    # A dead server often errors on the way out; the reconnect path already warned
+                    log.debug("MCP server task ended with %r", e)
+
+        def abandon(_task):
+            if not started.done():  # owner cancelled before the handshake finished
+                started.cancel()
+
+        task = asyncio.create_task(own(), name=f"mcp:{params.command}")
+        task.add_done_callback(abandon)
+        session = await started
+        return session, stop, task
+
+    def _server_of(self, session: ClientSession) -> Optional[str]:
+        for name, entry in self.servers.items():
+            if entry["session"] is session:
+                return name
+        return None
+
+    async def _reconnect_server(self, server_name: str, dead: ClientSession) -> ClientSession:
+        """Relaunch one server whose session died and repoint its tools; other servers are untouched."""
+        entry = self.servers[server_name]
+        async with entry["lock"]:
+            if entry["session"] is not dead:
+                return entry["session"]  # another call already reconnected it
+            log.warning("MCP server %s connection lost; relaunching", server_name)
+            session, stop, task = await self._launch_server(entry["params"])
+            entry["stop"].set()  # let the old owner task unwind
+            entry.update(session=session, stop=stop, task=task)
+            for name in entry["tool_names"]:
+                self.tool_to_session[name] = session
+            self.sessions = [session if s is dead else s for s in self.sessions]
+            self._batch_sessions = [session if s is dead else s for s in self._batch_sessions]
+            return session
+
+    async def _session_call(self, session: ClientSession, tool_name: str, arguments: Dict):
+        """session.call_tool, relaunching the server and retrying once if its connection is gone."""
+        try:
+            return await session.call_tool(name=tool_name, arguments=arguments)
+        except Exception as e:
+            server_name = self._server_of(session)
+            if server_name is None or not _is_connection_lost(e):
+                raise
+            session = await self._reconnect_server(server_name, session)
+            return await session.call_tool(name=tool_name, arguments=arguments)
 
     # ----- Tool invocation -----
+    def _cache_key(self, tool_name: str, tool_args: Dict) -> Optional[str]:
+        """Cache key for a call: tool name + canonical args JSON (None for uncached tools)."""
+        if tool_name in UNCACHED_TOOLS:
+            return None
+        return f"{tool_name}:{_dumps(tool_args, sort_keys=True)}"
+
+    def _cache_get(self, key: Optional[str]) -> Optional[str]:
+        """Cached tool result for key, or None if missing/expired (expired entries are evicted)."""
+        entry = self._tool_cache.get(key) if key else None
+        if entry is None:
+            return None
+        stored_at, text = entry
+        if time.monotonic() - stored_at > TOOL_CACHE_TTL_S:
+            del self._tool_cache[key]
+            return None
+        return text
+
+    def _cache_put(self, key: Optional[str], text: str) -> None:
+        # Tools report failures (RxNorm HTTP errors, bad arguments) as ordinary text, not
+        # isError; caching those would replay a transient failure for the whole TTL
+        if not key or _is_error_reply(text):
+            return
+        self._tool_cache[key] = (time.monotonic(), text)
+        if len(self._tool_cache) > TOOL_CACHE_MAX_ENTRIES:
+            # dicts keep insertion order: drop the oldest entry
+            del self._tool_cache[next(iter(self._tool_cache))]
+
+    @staticmethod
+    def _result_text(result) -> str:
+        """Flatten typical MCP call_tool result content to text."""
+        parts: List[str] = []
+        if getattr(result, "content", None):
+            for c in result.content:
+                if getattr(c, "type", "") == "text":
+                    parts.append(getattr(c, "text", ""))
+                else:
+                    # Fallback: stringify other payloads
+                    try:
+                        parts.append(_dumps(getattr(c, "dict", lambda: str(c))()))
+                    except Exception:
+                        parts.append(str(c))
+        return "\n".join([p for p in parts if p]) or "(empty tool result)"
+
     async def _call_tool_text(self, tool_name: str, tool_args: Dict) -> str:
-        """Invoke MCP tool and flatten typical result content to text."""
+        """Invoke MCP tool and flatten its result to text (identical calls are TTL-cached)."""
         session = self.tool_to_session.get(tool_name)
         if not session:
             return f"[tool error] Unknown tool: {tool_name}"
+        cache_key = self._cache_key(tool_name, tool_args)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            log.info("_call_tool_text: cache hit for %s", tool_name)
+            return cached
         try:
-            result = await session.call_tool(name=tool_name, arguments=tool_args)
-            parts: List[str] = []
-            if getattr(result, "content", None):
-                for c in result.content:
-                    if getattr(c, "type", "") == "text":
-                        parts.append(getattr(c, "text", ""))
-                    else:
-                        # Fallback: stringify other payloads
-                        try:
-                            parts.append(json.dumps(getattr(c, "dict", lambda: str(c))(), default=str))
-                        except Exception:
-                            parts.append(str(c))
-            return "\n".join([p for p in parts if p]) or "(empty tool result)"
+            result = await self._session_call(session, tool_name, tool_args)
+            text = self._result_text(result)
+            if not getattr(result, "isError", False):
+                self._cache_put(cache_key, text)
+            return text
         except Exception as e:
             log.exception("Tool call failed: %s", tool_name)
             return f"[tool error] {tool_name}: {e}"
 
+    async def _call_batch(self, session: ClientSession, calls: List[Dict]) -> List[str]:
+        """Send several calls to one server as a single batch_execute request."""
+        ops = [{'tool': c['name'], 'args': c.get('input') or {}} for c in calls]
+        result = await self._session_call(session, BATCH_TOOL, {'ops': ops})
+        if getattr(result, "isError", False):
+            raise RuntimeError(self._result_text(result))
+        items = json.loads(self._result_text(result))
+        if len(items) != len(calls):
+            raise RuntimeError(f"{BATCH_TOOL} returned {len(items)} results for {len(calls)} ops")
+        texts = [str(item.get('result', '')) or "(empty tool result)" for item in items]
+        for call, text in zip(calls, texts):
+            self._cache_put(self._cache_key(call['name'], call.get('input') or {}), text)
+        return texts
+
+    async def _call_tools_batched(self, calls: List[Dict]) -> List:
+        """
+        Run tool calls ({'name', 'input'} dicts) and return their result texts in call order.
+          - cache hits are answered locally
+          - misses are grouped per server session; a server advertising batch_execute
+            gets ONE request per group (one framing/parse cycle instead of N)
+          - everything else is issued concurrently, which pipelines the JSON-RPC
+            frames over the session's stdio stream
+        Like asyncio.gather(return_exceptions=True), a failed call yields its exception.
+        """
+        results: List = [None] * len(calls)
+        groups: Dict[int, List[int]] = {}  # id(session) -> indices of calls to batch
+        singles: List[int] = []
+        for i, call in enumerate(calls):
+            args = call.get('input') or {}
+            cached = self._cache_get(self._cache_key(call['name'], args))
+            if cached is not None:
+                results[i] = cached
+                continue
+            session = self.tool_to_session.get(call['name'])
+            if session is not None and session in self._batch_sessions:
+                groups.setdefault(id(session), []).append(i)
+            else:
+                singles.append(i)
+
+        async def run_group(idxs: List[int]) -> None:
+            group_calls = [calls[i] for i in idxs]
+            try:
+                texts = await self._call_batch(self.tool_to_session[group_calls[0]['name']], group_calls)
+            except Exception:
+                log.exception("%s failed; falling back to individual calls", BATCH_TOOL)
+                texts = await asyncio.gather(
+                    *(self._call_tool_text(c['name'], c.get('input') or {}) for c in group_calls),
+                    return_exceptions=True,
+                )
+            for i, text in zip(idxs, texts):
+                results[i] = text
+
+        async def run_single(i: int) -> None:
+            results[i] = await self._call_tool_text(calls[i]['name'], calls[i].get('input') or {})
+
+        jobs = [run_group(idxs) if len(idxs) > 1 else run_single(idxs[0]) for idxs in groups.values()]
+        jobs += [run_single(i) for i in singles]
+        outcomes = await asyncio.gather(*jobs, return_exceptions=True)
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                log.error("tool job failed: %r", outcome)
+        # Any slot a failed job never filled carries an error for the caller
+        return [r if r is not None else RuntimeError("tool call did not complete") for r in results]
+
+    # ----- Model calls -----
+    def _build_tools_request(self) -> Tuple[Dict, ...]:
+        """
+        Tools list for requests. No cache breakpoint here: the tools block alone is well under
+        the minimum cacheable prefix; the breakpoint goes on the messages instead.
+        """
+        return tuple(self.available_tools)
+
+    async def _stream_message(self, on_text: Optional[Callable[[str], None]], **kwargs):
+        """Stream one model turn, forwarding text deltas to on_text; return the final Message."""
+        async with self.anthropic.messages.stream(**kwargs) as stream:
+            async for event in stream:
+                if on_text and event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+                    on_text(event.delta.text)
+            # Canonical content (text + fully parsed tool_use inputs) for the memory
+            return await stream.get_final_message()
+
+    @staticmethod
+    def _split_reply(content) -> Tuple[str, List[Dict]]:
+        """Classify a model reply in one pass: (joined text, tool_use calls as dicts)."""
+        text_chunks: List[str] = []
+        tool_calls: List[Dict] = []
+        for item in content:
+            if item.type == 'text':
+                text_chunks.append(item.text or "")
+            elif item.type == 'tool_use':
+                tool_calls.append({'id': item.id, 'name': item.name, 'input': item.input})
+        return "".join(text_chunks).strip() or "(empty response)", tool_calls
+
+    # ----- Memory compaction -----
+    def _compact_messages(self, messages: List[Dict]) -> None:
+        """
+        Gist older turns in place so prompt size stops growing with every turn:
+          - keep the last KEEP_RECENT_TURNS completed turns verbatim
+          - fold everything older into one user message listing each query,
+            the tools it called (name + args), a one-line gist of each tool
+            result, and the answer
+          - cap that gist at MAX_GIST_LINES by dropping its oldest whole turns
+        A completed turn ends with a plain-text assistant message (the final answer).
+        """
+        if len(messages) <= COMPACT_AFTER_MESSAGES:
+            return
+        turn_ends = [
+            i for i, m in enumerate(messages)
+            if m['role'] == 'assistant' and isinstance(m['content'], str)
+        ]
+        if len(turn_ends) <= KEEP_RECENT_TURNS:
+            return
+        cut = turn_ends[-(KEEP_RECENT_TURNS + 1)] + 1
+
+        # One list of gist lines per turn, so trimming never splits a question from its answer
+        turns: List[List[str]] = []
+        omitted = False
+        turn_start = True
+
+        def add(line: str) -> None:
+            if line.startswith("- User asked:") or not turns:
+                turns.append([])
+            turns[-1].append(line)
+
+        for m in messages[:cut]:
+            content = m['content']
+            if m['role'] == 'user' and isinstance(content, str):
+                if content.startswith(COMPACTED_PREFIX):
+                    for line in content[len(COMPACTED_PREFIX):].strip().splitlines():
+                        if line == GIST_OMITTED_NOTE:
+                            omitted = True
+                        else:
+                            add(line)
+                elif turn_start:
+                    add(f"- User asked: {_clip(content, 200)}")
+                # other plain user text is loop steering; not worth keeping
+            elif m['role'] == 'user':
+                for block in content:
+                    if _field(block, 'type') == 'tool_result':
+                        add(f"    result: {_clip(_field(block, 'content'), 160)}")
+            elif isinstance(content, str):
+                add(f"  Answer: {_clip(content, 300)}")
+            else:
+                for block in content:
+                    if _field(block, 'type') == 'tool_use':
+                        args = _dumps(_field(block, 'input') or {})
+                        add(f"  Called {_field(block, 'name')}({_clip(args, 160)})")
+            # The next message opens a new turn after a final answer or an earlier gist
+            turn_start = isinstance(content, str) and (
+                m['role'] == 'assistant' or content.startswith(COMPACTED_PREFIX)
+            )
+
+        # Drop the oldest whole turns until the gist fits (the newest is always kept)
+        n_lines = sum(len(t) for t in turns)
+        while len(turns) > 1 and n_lines > MAX_GIST_LINES:
+            n_lines -= len(turns.pop(0))
+            omitted = True
+
+        lines = [GIST_OMITTED_NOTE] if omitted else []
+        lines.extend(line for t in turns for line in t)
+        summary = "\n".join(lines)
+        messages[:cut] = [{'role': 'user', 'content': f"{COMPACTED_PREFIX}\n{summary}"}]
+        log.info("_compact_messages: folded %d messages into a %d-line gist", cut, len(lines))
+
     # ----- Core query flow with memory -----
-    async def process_query(self, query: str) -> str:
+    async def process_query(
+        self,
+        query: str,
+        messages: List[Dict],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> str:
         """
         Iterative tool loop with anti-churn guard (Anthropic-compliant):
-          - Append user turn
-          - Ask model
+          - Append user turn to the caller's conversation memory
+            (one list per session; items are {'role': 'user'|'assistant', 'content': <str|list[blocks]>})
+          - Ask model (streamed; text deltas go to on_text as they arrive)
           - If tool_use appears, produce tool_result immediately (no interleaving text)
+          - Refuse search_drugs calls past MAX_SEARCHES_PER_QUERY with an error tool_result
           - Limit to MAX_TOOL_LOOPS and nudge model to stop repeating
+        If the query fails or is cancelled, messages is restored to its state before the call.
         """
-        log.info("process_query: begin; query=%r", query[:200])
+        log.info("process_query: begin; query=%.200r", query)
+        # The frontend connects servers in the background, so a query can arrive before the
+        # tool set exists; wait for it rather than answering without tools
+        await self.ready_event.wait()
+        if self.connect_error:
+            raise RuntimeError(f"Drug tools are unavailable ({self.connect_error})")
+
+        # A failed or cancelled query (error, timeout, closed tab) must not leave half a turn
+        # behind (e.g. a tool_use with no tool_result), so restore the memory on the way out
+        snapshot = list(messages)
+        try:
+            return await self._run_query(query, messages, on_text)
+        except BaseException:
+            messages[:] = snapshot
+            raise
+
+    async def _run_query(
+        self,
+        query: str,
+        messages: List[Dict],
+        on_text: Optional[Callable[[str], None]],
+    ) -> str:
+        # 0) Gist older turns so the resent history stays bounded
+        self._compact_messages(messages)
 
         # 1) Add user turn to memory
-        self.messages.append({'role': 'user', 'content': query})
+        messages.append({'role': 'user', 'content': query})
 
-        from collections import Counter
         seen_tools = Counter()
-
-        MAX_TOOL_LOOPS = 6
         loop_idx = 0
 
         while True:
             loop_idx += 1
-            response = self.anthropic.messages.create(
-                model='claude-3-7-sonnet-20250219',
+            response = await self._stream_message(
+                on_text,
+                model=MODEL_NAME,
                 max_tokens=2024,
-                tools=self.available_tools,
-                messages=self.messages,
+                tools=self._tools_request,
+                messages=_with_cache_breakpoint(messages),
             )
 
-            log.info("model reply types: %s", [getattr(x, "type", "?") for x in response.content])
+            if log.isEnabledFor(logging.INFO):
+                log.info("model reply types: %s", [getattr(x, "type", "?") for x in response.content])
 
-            tool_calls = []
-            free_text_chunks = []
-
-            for item in response.content:
-                if item.type == 'text':
-                    free_text_chunks.append(item.text or "")
-                elif item.type == 'tool_use':
-                    tool_calls.append({'id': item.id, 'name': item.name, 'input': item.input})
+            final_text, tool_calls = self._split_reply(response.content)
 
             # If no tools requested, finalize with text
             if not tool_calls:
-                final_text = "".join(free_text_chunks).strip() or "(empty response)"
-                self.messages.append({'role': 'assistant', 'content': final_text})
+                messages.append({'role': 'assistant', 'content': final_text})
                 log.info("process_query: done; loops=%d; len=%d", loop_idx, len(final_text))
                 return final_text
 
             # Record assistant turn (with tool_use)
-            self.messages.append({'role': 'assistant', 'content': response.content})
-
-            # --- Anti-churn accounting (do NOT inject user text yet) ---
-            for call in tool_calls:
+            messages.append({'role': 'assistant', 'content': response.content})
+
+            # --- Anti-churn accounting ---
+            # The tools list stays fixed (changing it mid-query would invalidate the cached
+            # prefix), so searches past the budget are answered with an error instead of run
+            refused = set()
+            for i, call in enumerate(tool_calls):
+                if call['name'] == 'search_drugs' and seen_tools['search_drugs'] >= MAX_SEARCHES_PER_QUERY:
+                    refused.add(i)
                 seen_tools[call['name']] += 1
+                log.info("process_query: tool_use -> %s args=%.300s", call['name'], call.get('input'))
 
-            # Build tool_result blocks that must come IMMEDIATELY after tool_use
+            # Build tool_result blocks that must come IMMEDIATELY after tool_use,
+            # in the original tool_use order (the calls themselves run concurrently)
+            ran = iter(await self._call_tools_batched(
+                [call for i, call in enumerate(tool_calls) if i not in refused]
+            ))
             tool_result_blocks = []
-            suppress_msg_needed = False
-
-            for call in tool_calls:
-                t_name = call['name']
-                t_args = call.get('input', {}) or {}
-                if t_name == 'search_drugs' and seen_tools.get('search_drugs', 0) > 2:
-                    # Suppress further identical searches; still emit a tool_result for protocol compliance
-                    log.info("process_query: suppressing extra search_drugs; args=%s", str(t_args)[:300])
-                    tool_result_blocks.append({
-                        'type': 'tool_result',
-                        'tool_use_id': call['id'],
-                        'content': ("[anti-churn] Repeated search_drugs suppressed. "
-                                    "Please either call get_drug_properties or summarize results."),
-                        'is_error': True,  # optional but useful signal
+            for i, call in enumerate(tool_calls):
+                block = {'type': 'tool_result', 'tool_use_id': call['id']}
+                if i in refused:
+                    block.update({
+                        'content': (
+                            f"[anti-churn] search_drugs limit ({MAX_SEARCHES_PER_QUERY} per question) "
+                            "reached; answer from the results you already have."
+                        ),
+                        'is_error': True,
                     })
-                    suppress_msg_needed = True
+                    tool_result_blocks.append(block)
+                    continue
+                result = next(ran)
+                if isinstance(result, BaseException):
+                    block.update({'content': f"[tool error] {call['name']}: {result}", 'is_error': True})
                 else:
-                    log.info("process_query: tool_use -> %s args=%s", t_name, str(t_args)[:300])
-                    result_text = await self._call_tool_text(t_name, t_args)
-                    tool_result_blocks.append({
-                        'type': 'tool_result',
-                        'tool_use_id': call['id'],
-                        'content': result_text,
-                    })
+                    block['content'] = _trim_tool_result(call['name'], result)
+                tool_result_blocks.append(block)
 
             # Post the REQUIRED immediate tool_result message
-            self.messages.append({'role': 'user', 'content': tool_result_blocks})
-
-            # Now it's safe to add steering text (if we suppressed)
-            if suppress_msg_needed:
-                self.messages.append({
-                    'role': 'user',
-                    'content': (
-                        "You already performed multiple searches. Do not call search_drugs again. "
-                        "If details are needed, call get_drug_properties; otherwise, write the final answer now."
-                    )
-                })
+            messages.append({'role': 'user', 'content': tool_result_blocks})
 
             # Safety stop
             if loop_idx >= MAX_TOOL_LOOPS:
                 log.warning("process_query: reached MAX_TOOL_LOOPS without final text")
                 # Nudge the model once more (AFTER a valid tool_result turn)
-                self.messages.append({
+                messages.append({
                     'role': 'user',
                     'content': 'Stop calling tools. Summarize the findings from the tool results above in clear prose.'
                 })
-                response2 = self.anthropic.messages.create(
-                    model='claude-3-7-sonnet-20250219',
-                    max_tokens=2024,
-                    tools=self.available_tools,
-                    messages=self.messages,
+                # Text-only summary on the cheaper model. Tools stay declared because the
+                # history holds tool_use blocks, but tool_choice 'none' forbids new calls.
+                response2 = await self._stream_message(
+                    on_text,
+                    model=SUMMARY_MODEL_NAME,
+                    max_tokens=1024,
+                    tools=self._tools_request,
+                    tool_choice={'type': 'none'},
+                    messages=messages,
                 )
-                final_chunks = [c.text for c in response2.content if getattr(c, "type", "") == "text"]
-                final_text = "".join(final_chunks).strip() or "(empty response)"
-                self.messages.append({'role': 'assistant', 'content': final_text})
+                final_text, _ = self._split_reply(response2.content)
+                messages.append({'role': 'assistant', 'content': final_text})
                 return final_text
 
-    # ----- Background runner (async loop living in a worker thread) -----
-    async def run_chatbot(self, in_q: Queue, out_q: Queue):
-        """Async loop: read queries from sync queue, process, write responses back to sync queue."""
+    # ----- Background runner (CLI harness) -----
+    async def run_chatbot(self, in_q: asyncio.Queue, out_q: asyncio.Queue):
+        """
+        Async loop: read queries from in_q, process, write responses to out_q (same event loop).
+        Each query yields zero or more ('delta', text) items followed by one ('done', final_text);
+        'quit' is answered with ('exit', text) and ends the loop.
+        """
+        messages: List[Dict] = []  # one CLI session
         try:
             await self.connect_to_servers()
             log.info("run_chatbot: ready for queries")
             while True:
-                query = await asyncio.to_thread(in_q.get)  # blocking get in a worker
+                query = await in_q.get()
                 if isinstance(query, str) and query.lower() == "quit":
-                    await asyncio.to_thread(out_q.put, "Exiting chatbot...")
+                    out_q.put_nowait(("exit", "Exiting chatbot..."))
                     break
 
                 try:
-                    response = await self.process_query(query)
-                    await asyncio.to_thread(out_q.put, response)
+                    response = await self.process_query(
+                        query, messages, on_text=lambda d: out_q.put_nowait(("delta", d))
+                    )
+                    out_q.put_nowait(("done", response))
                 except Exception as e:
                     log.exception("run_chatbot: error while processing query")
-                    await asyncio.to_thread(out_q.put, f"[ERROR]: {str(e)}")
+                    out_q.put_nowait(("done", f"[ERROR]: {str(e)}"))
         finally:
-            log.info("run_chatbot: closing resources")
-            await self.exit_stack.aclose()
-            log.info("run_chatbot: closed")
+            await self.close()
 
-# ---------- Thread entrypoint ----------
-def start_async_loop(chatbot: MCP_ChatBot, in_q: Queue, out_q: Queue):
-    """Runs the async engine inside a dedicated thread."""
-    asyncio.run(chatbot.run_chatbot(in_q, out_q))
+    async def close(self):
+        """Close every MCP session and stop the server subprocesses."""
+        log.info("close: closing resources")
+        for entry in self.servers.values():
+            entry["stop"].set()
+        await asyncio.gather(*(e["task"] for e in self.servers.values()), return_exceptions=True)
+        log.info("close: closed")
 
 
 # ---------- Simple CLI harness (for local testing) ----------
+def _read_stdin(loop: asyncio.AbstractEventLoop, in_q: asyncio.Queue):
+    """Stdin reader thread: hands each typed line to the event loop's queue."""
+    while True:
+        try:
+            line = input().strip()
+        except EOFError:
+            line = "quit"
+        loop.call_soon_threadsafe(in_q.put_nowait, line)
+        if line.lower() == "quit":
+            return
+
+
+async def run_cli(bot: MCP_ChatBot):
+    """Drive run_chatbot from the console; only the blocking stdin read lives in a thread."""
+    in_q: asyncio.Queue = asyncio.Queue()
+    out_q: asyncio.Queue = asyncio.Queue()
+    engine = asyncio.create_task(bot.run_chatbot(in_q, out_q))
+    threading.Thread(
+        target=_read_stdin,
+        args=(asyncio.get_running_loop(), in_q),
+        daemon=True,
+        name="StdinReader",
+    ).start()
+
+    print("MCP Chatbot started. Type queries or 'quit' to exit.")
+    print("\nQuery: ", end="", flush=True)
+    streamed = False
+    while True:
+        kind, payload = await out_q.get()
+        if kind == "delta":
+            if not streamed:
+                print("\nResponse:")
+            print(payload, end="", flush=True)
+            streamed = True
+        elif kind == "done":
+            print("" if streamed else f"\nResponse:\n{payload}")
+            print("\nQuery: ", end="", flush=True)
+            streamed = False
+        else:  # 'exit'
+            print(payload)
+            break
+    await engine
+
+
 def main():
     """
     Local CLI runner:
-      - Starts the async engine in a worker thread
+      - Runs the async engine on this thread's event loop
       - Lets you type queries in the console
       - Type 'quit' to stop
     """
-    in_q: Queue = Queue()
-    out_q: Queue = Queue()
-    bot = MCP_ChatBot()
-
-    worker = threading.Thread(
-        target=start_async_loop,
-        args=(bot, in_q, out_q),
-        daemon=True,
-        name="AsyncWorker",
-    )
-    worker.start()
-
-    print("MCP Chatbot started. Type queries or 'quit' to exit.")
     try:
-        while True:
-            q = input("\nQuery: ").strip()
-            in_q.put(q)
-            if q.lower() == "quit":
-                msg = out_q.get(timeout=10)
-                print(msg)
-                break
-            resp = out_q.get()
-            print("\nResponse:\n", resp)
+        asyncio.run(run_cli(MCP_ChatBot()))
     except KeyboardInterrupt:
         print("\nInterrupted. Exiting...")
-    finally:
-        worker.join(timeout=2)
 
 
 if __name__ == "__main__":
@@ -1,48 +1,72 @@
 import os
-import threading
+import time
 import asyncio
-from queue import Queue
-from typing import Dict, Optional
+from typing import Set
 
-from nicegui import ui, app
+from nicegui import ui, app, background_tasks
 from fastapi import Response
 
-from backend import MCP_ChatBot, start_async_loop
+from backend import MCP_ChatBot
 
 # ---------------------------
 # Shared backend engine
 # ---------------------------
-in_q: Queue = Queue()
-out_q: Queue = Queue()
-
+# Runs on NiceGUI's own event loop: each Ask is its own task awaiting
+# chatbot.process_query, so clients no longer queue behind one worker.
+# Constructing it is side-effect free; servers spawn only in the serving process's startup.
 chatbot = MCP_ChatBot()
 
-worker = threading.Thread(
-    target=start_async_loop,
-    args=(chatbot, in_q, out_q),
-    daemon=True,
-    name="AsyncWorker",
-)
-worker.start()
+# Minimum interval between streamed-text updates of an answer bubble
+STREAM_FLUSH_S = 0.1
 
-# ---------------------------
-# Per-client timer registry
-# ---------------------------
-timers_by_client: Dict[str, Optional[ui.timer]] = {}
+# Upper bound on one query (model turns + tool calls) once it holds a slot; the user gets
+# an error instead of a hang
+QUERY_TIMEOUT_S = float(os.environ.get('QUERY_TIMEOUT_S', '60'))
 
-def _cancel_timer_for(client_id: str) -> None:
-    t = timers_by_client.get(client_id)
-    if t is not None:
-        try:
-            t.cancel()
-        except Exception:
-            pass
-    timers_by_client[client_id] = None
+# Queries already run concurrently on the one shared engine (its MCP sessions multiplex
+# calls), so a pool of engines would only multiply server subprocesses. What needs bounding
+# is how many queries hit the Anthropic API at once; the rest wait for a slot.
+MAX_CONCURRENT_QUERIES = int(os.environ.get('MAX_CONCURRENT_QUERIES', '4'))
+query_slots = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+
+# A query waits at most SLOT_WAIT_S for a slot, and at most MAX_WAITING_QUERIES may wait;
+# past either limit the user is told the server is busy instead of waiting for a timeout
+SLOT_WAIT_S = float(os.environ.get('SLOT_WAIT_S', '15'))
+MAX_WAITING_QUERIES = int(os.environ.get('MAX_WAITING_QUERIES', '32'))
+BUSY_REPLY = "⚠️ Server is busy, please retry in a moment."
+waiting_queries = 0
+
+class ServerBusy(Exception):
+    """No query slot freed up within SLOT_WAIT_S."""
 
-def _on_disconnect(client):
-    _cancel_timer_for(client.id)
+def server_busy() -> bool:
+    return query_slots.locked() and waiting_queries >= MAX_WAITING_QUERIES
 
-app.on_disconnect(_on_disconnect)
+async def run_query(query: str, messages: list, on_text) -> str:
+    """process_query once a query slot is free (ServerBusy if none frees up in time)."""
+    global waiting_queries
+    waiting_queries += 1
+    try:
+        await asyncio.wait_for(query_slots.acquire(), timeout=SLOT_WAIT_S)
+    except asyncio.TimeoutError:
+        raise ServerBusy() from None
+    finally:
+        waiting_queries -= 1
+    try:
+        return await asyncio.wait_for(
+            chatbot.process_query(query, messages, on_text=on_text),
+            timeout=QUERY_TIMEOUT_S,
+        )
+    finally:
+        query_slots.release()
+
+@app.on_startup
+def _boot():
+    # Connect in the background: NiceGUI awaits startup handlers before serving, so awaiting
+    # the MCP handshake here would hold back /health (and Railway's deploy probe) until done
+    background_tasks.create(chatbot.connect_to_servers(), name='connect_to_servers')
+
+app.on_shutdown(chatbot.close)
 
 # ---------------------------
 # Healthcheck
@@ -54,19 +78,38 @@ def healthcheck():
 # ---------------------------
 # Small helpers: chat bubbles
 # ---------------------------
+# Each bubble is ONE styled label (not row > card > label), so a message adds a single
+# element to the page and its update over the websocket
+_BUBBLE_CLASSES = 'max-w-[80%] rounded-2xl p-3 shadow whitespace-pre-wrap text-gray-900'
+USER_BUBBLE_CLASSES = f'{_BUBBLE_CLASSES} self-end bg-blue-50 border border-blue-200'
+ASSISTANT_BUBBLE_CLASSES = f'{_BUBBLE_CLASSES} self-start bg-gray-50 border border-gray-200'
+
 def add_user_bubble(container: ui.column, text: str):
     """Right-aligned user bubble."""
     with container:
-        with ui.row().classes('w-full justify-end'):
-            with ui.card().classes('max-w-[80%] bg-blue-50 border border-blue-200 rounded-2xl p-3'):
-                ui.label(text).classes('whitespace-pre-wrap text-gray-900')
+        ui.label(text).classes(USER_BUBBLE_CLASSES)
 
-def add_assistant_bubble(container: ui.column, text: str):
-    """Left-aligned assistant bubble."""
+def add_assistant_bubble(container: ui.column, text: str) -> ui.label:
+    """Left-aligned assistant bubble; returns its label so streamed text can be appended."""
     with container:
-        with ui.row().classes('w-full justify-start'):
-            with ui.card().classes('max-w-[80%] bg-gray-50 border border-gray-200 rounded-2xl p-3'):
-                ui.label(text).classes('whitespace-pre-wrap text-gray-900')
+        return ui.label(text).classes(ASSISTANT_BUBBLE_CLASSES)
+
+# ---------------------------
+# Static page text
+# ---------------------------
+# Built once per process. ui.markdown memoizes its markdown -> HTML conversion on the
+# content string, so the sample list is parsed on the first page load only.
+DESCRIPTION = (
+    'I can help you with information about drugs and medications by searching RxNorm, '
+    'a standardized drug nomenclature database.'
+)
+SAMPLE_QUESTIONS_MD = '\n'.join(f'- {q}' for q in (
+    'What is Lipitor used for?',
+    'Tell me about metformin.',
+    'What are the properties of ibuprofen?',
+    'Is Zoloft the same as sertraline?',
+    'What medications contain pseudoephedrine?',
+))
 
 # ---------------------------
 # Main page (per-client UI)
@@ -75,26 +118,37 @@ def add_assistant_bubble(container: ui.column, text: str):
 def index():
     is_paas = bool(os.environ.get('PORT'))
     client = ui.context.client
+    # Conversation memory for this browser tab only
+    session_messages: list = []
+
+    # Status watcher + in-flight queries of this tab, cancelled once the client is gone.
+    # Owned by the page (not a module-level dict keyed by client id), so there is no
+    # shared registry to clean up or race on
+    client_tasks: Set[asyncio.Task] = set()
+
+    def track_task(task: asyncio.Task) -> None:
+        client_tasks.add(task)
+        task.add_done_callback(client_tasks.discard)
+
+    def cancel_tasks() -> None:
+        for t in list(client_tasks):
+            t.cancel()
+
+    # on_delete, not on_disconnect: a websocket drop the browser reconnects from within
+    # reconnect_timeout must not kill the tab's running query
+    client.on_delete(cancel_tasks)
 
     with ui.column().classes('w-full max-w-4xl mx-auto'):
         # Header with status
         with ui.row().classes('items-center gap-3'):
             ui.label('Drug Finder').classes('text-2xl font-bold')
             status_dot = ui.icon('circle').classes('text-gray-400')
-            status_text = ui.label('Tools: —').classes('text-gray-600')
+            status_text = ui.label('Loading tools…').classes('text-gray-600')
 
-        # Description + sample questions (your modified text version is fine)
-        ui.label(
-            'I can help you with information about drugs and medications by searching RxNorm, a standardized drug nomenclature database.'
-        ).classes('text-gray-600')
+        # Description + sample questions
+        ui.label(DESCRIPTION).classes('text-gray-600')
         ui.label('Here are some sample questions:').classes('text-gray-600')
-        ui.markdown(
-            '- What is Lipitor used for?\n'
-            '- Tell me about metformin.\n'
-            '- What are the properties of ibuprofen?\n'
-            '- Is Zoloft the same as sertraline?\n'
-            '- What medications contain pseudoephedrine?'
-        ).classes('text-gray-600')
+        ui.markdown(SAMPLE_QUESTIONS_MD).classes('text-gray-600')
 
         # Input
         query_box = ui.input(
@@ -109,39 +163,93 @@ def index():
         with ui.scroll_area().classes('w-full h-80 border rounded-lg p-3 bg-white mt-4'):
             chat_container = ui.column().classes('w-full gap-2')
 
-        # Ask handler
+        # Ask handler (one query at a time per tab: duplicate clicks would only
+        # repeat the same paid model calls)
+        busy = False
+
         async def ask_query():
+            nonlocal busy
             q = (query_box.value or '').strip()
-            if not q:
+            if busy or not q:
                 return
-            # Clear input and show user bubble immediately
-            query_box.value = ''
-            add_user_bubble(chat_container, q)
-            spinner.visible = True
+            busy = True
+            ask_btn.disable()
+            query_box.disable()
+            try:
+                # Clear input and show user bubble immediately
+                query_box.value = ''
+                add_user_bubble(chat_container, q)
+                if server_busy():
+                    add_assistant_bubble(chat_container, BUSY_REPLY)
+                    return
+                spinner.visible = True
 
-            # Send to backend
-            in_q.put(q)
+                # Stream the assistant response into its bubble
+                answer = add_assistant_bubble(chat_container, '')
 
-            # Wait for the assistant response (non-blocking)
-            response = await asyncio.to_thread(out_q.get)
-            add_assistant_bubble(chat_container, response)
-            # print(response)
-            spinner.visible = False
+                # Each text update re-sends the whole bubble over the websocket, so coalesce
+                # stream deltas and flush at most every STREAM_FLUSH_S. A deferred flush picks
+                # up text that arrives just before a pause (e.g. ahead of a tool call), so the
+                # bubble never lags by more than one interval.
+                pending: list = []
+                last_flush = 0.0
+                flush_handle = None
 
-        ui.button(
+                def flush():
+                    nonlocal last_flush, flush_handle
+                    flush_handle = None
+                    if pending:
+                        answer.text += ''.join(pending)
+                        pending.clear()
+                    last_flush = time.monotonic()
+
+                def on_text(delta: str):
+                    nonlocal flush_handle
+                    pending.append(delta)
+                    if flush_handle is not None:
+                        return
+                    delay = STREAM_FLUSH_S - (time.monotonic() - last_flush)
+                    if delay <= 0:
+                        flush()
+                    else:
+                        flush_handle = asyncio.get_running_loop().call_later(delay, flush)
+
+                # This handler already runs as its own task: register it so closing the tab
+                # cancels the query (and its model/tool calls) instead of letting it run on
+                track_task(asyncio.current_task())
+                try:
+                    response = await run_query(q, session_messages, on_text)
+                except ServerBusy:
+                    response = BUSY_REPLY
+                except asyncio.TimeoutError:
+                    response = "⚠️ Backend timed out, please retry."
+                except asyncio.CancelledError:
+                    # Client deleted or app shutting down; say so if anyone can still see it
+                    if client.has_socket_connection:
+                        answer.text = "⚠️ Query cancelled."
+                    raise
+                except Exception as e:
+                    response = f"[ERROR]: {str(e)}"
+                finally:
+                    # No deferred flush may land on top of the final (or cancelled) text
+                    if flush_handle is not None:
+                        flush_handle.cancel()
+                # The returned text is the final answer (drops any interim tool-loop chatter)
+                answer.text = response
+            finally:
+                busy = False
+                spinner.visible = False
+                ask_btn.enable()
+                query_box.enable()
+
+        ask_btn = ui.button(
             'Ask',
             on_click=ask_query
         ).classes('mt-2 px-4 py-2 bg-blue-600 text-white rounded-lg hover:bg-blue-700')
 
         # Quit (only local)
         def shutdown_app():
-            in_q.put("quit")
-            try:
-                _ = out_q.get(timeout=5)
-            except Exception:
-                pass
-            app.shutdown()
-            worker.join(timeout=2)
+            app.shutdown()  # on_shutdown closes the MCP sessions
 
         if not is_paas:
             ui.button(
@@ -150,20 +258,25 @@ def index():
             ).classes('mt-4 px-6 py-3 bg-red-600 text-white rounded-lg hover:bg-red-700')
 
         # ---------------------------
-        # Status updater: show tool names
+        # Status updater: show tool names once the backend signals ready
         # ---------------------------
-        def update_status():
-            tools = getattr(chatbot, 'available_tools', [])
-            names = [t.get('name') for t in tools] if tools else []
-            if names:
-                status_dot.classes(replace='text-green-500')
-                status_text.set_text('Tools: ' + ', '.join(names))
-                _cancel_timer_for(client.id)
-            else:
-                status_dot.classes(replace='text-gray-400')
-                status_text.set_text('Tools: —')
-
-        timers_by_client[client.id] = ui.timer(0.5, update_status)
+        def show_tools():
+            if chatbot.connect_error:
+                status_dot.classes(replace='text-red-500')
+                status_text.set_text(f'Tools unavailable: {chatbot.connect_error}')
+                return
+            names = [t.get('name') for t in chatbot.available_tools]
+            status_dot.classes(replace='text-green-500')
+            status_text.set_text('Tools: ' + ', '.join(names))
+
+        async def watch_ready():
+            await chatbot.ready_event.wait()
+            show_tools()
+
+        if chatbot.ready_event.is_set():
+            show_tools()  # the usual case after startup: no per-client task at all
+        else:
+            track_task(background_tasks.create(watch_ready()))
 
 # ---------------------------
 # Run mode
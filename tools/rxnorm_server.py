@@ -2,14 +2,66 @@
 # Tools:
 #   1) search_drugs(query, limit=5)
 #   2) get_drug_properties(rxcui)
+#   3) get_drug_properties_batch(rxcuis) -- many RXCUIs, fetched concurrently
+#   4) batch_execute(ops) -- client plumbing: runs several of the above in one request
 
-import json
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from typing import List, Dict, Any, Optional
 
-import requests
+import httpx
+import orjson
 from mcp.server.fastmcp import FastMCP
 
-mcp = FastMCP("rxnorm")
+# One shared async client: pooled keep-alive (HTTP/2) connections to rxnav, and tool
+# calls that overlap their network waits instead of blocking the server's event loop
+CLIENT = httpx.AsyncClient(
+    timeout=20,
+    headers={"Accept": "application/json", "Accept-Encoding": "gzip"},
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+    ),
+)
+
+@asynccontextmanager
+async def _lifespan(_server: FastMCP):
+    try:
+        yield {}
+    finally:
+        await CLIENT.aclose()
+
+mcp = FastMCP("rxnorm", lifespan=_lifespan)
+
+# RxNorm data is effectively static, so successful lookups are cached in-process (LRU).
+# The TTL bucket is part of each cache key: entries roll over once per period.
+CACHE_TTL_S = 3600
+CACHE_MAX_ENTRIES = 1024
+_cache: "OrderedDict[tuple, Any]" = OrderedDict()  # reply text or parsed properties
+
+def _ttl_bucket() -> int:
+    return int(time.time()) // CACHE_TTL_S
+
+def _cache_get(key: tuple) -> Any:
+    value = _cache.get(key)
+    if value is not None:
+        _cache.move_to_end(key)
+    return value
+
+def _cache_put(key: tuple, value: Any) -> Any:
+    _cache[key] = value
+    _cache.move_to_end(key)
+    if len(_cache) > CACHE_MAX_ENTRIES:
+        _cache.popitem(last=False)
+    return value
+
+def _to_json(obj: Any) -> str:
+    """Pretty-printed (2-space) JSON reply text; orjson is several times faster than json."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
 
 def _clip_limit(n: Optional[int], lo: int = 1, hi: int = 50, default: int = 5) -> int:
     try:
@@ -18,8 +70,72 @@ def _clip_limit(n: Optional[int], lo: int = 1, hi: int = 50, default: int = 5) -
     except Exception:
         return default
 
+# What a lookup can raise: transport/status errors, or a body that isn't JSON
+# (orjson.JSONDecodeError is a ValueError)
+RXNORM_ERRORS = (httpx.HTTPError, ValueError)
+
+def _rxnorm_error(e: Exception) -> Dict[str, str]:
+    if isinstance(e, httpx.HTTPError):
+        return {"error": f"HTTP error contacting RxNorm: {e}"}
+    return {"error": f"Invalid response from RxNorm: {e}"}
+
+def _json_object(r: httpx.Response) -> Dict[str, Any]:
+    """Parsed JSON object body ({} if empty); raises ValueError for anything else."""
+    data = (orjson.loads(r.content) if r.content else None) or {}
+    if not isinstance(data, dict):
+        raise ValueError(f"expected a JSON object, got {type(data).__name__}")
+    return data
+
+@dataclass(slots=True)
+class Concept:
+    """One search_drugs hit; orjson serializes it as an object with these keys, in order."""
+    rxcui: Optional[str]
+    name: Optional[str]
+    synonym: Optional[str]
+    tty: Optional[str]
+
+async def _search_drugs_cached(q: str, lim: int) -> str:
+    """HTTP + parse for search_drugs; raises one of RXNORM_ERRORS (errors are never cached)."""
+    key = ("search", q, lim, _ttl_bucket())
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    # RxNorm "drugs" endpoint groups results in conceptGroup[].conceptProperties[]
+    url = "https://rxnav.nlm.nih.gov/REST/drugs.json"
+    r = await CLIENT.get(url, params={"name": q})
+    r.raise_for_status()
+    data = _json_object(r)
+
+    # Stop as soon as lim concepts are collected instead of walking every group
+    results: List[Concept] = []
+    drug_group = (data.get("drugGroup") or {})
+    for grp in (drug_group.get("conceptGroup") or []):
+        for c in (grp.get("conceptProperties") or []):
+            results.append(Concept(c.get("rxcui"), c.get("name"), c.get("synonym"), c.get("tty")))
+            if len(results) >= lim:
+                break
+        if len(results) >= lim:
+            break
+
+    return _cache_put(key, _to_json({"query": q, "results": results}))
+
+async def _get_properties_cached(rx: str) -> Dict[str, Any]:
+    """HTTP + parse of one RXCUI's properties; raises one of RXNORM_ERRORS (errors are never cached)."""
+    key = ("properties", rx, _ttl_bucket())
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    url = f"https://rxnav.nlm.nih.gov/REST/rxcui/{rx}/properties.json"
+    r = await CLIENT.get(url)
+    r.raise_for_status()
+    data = _json_object(r)
+
+    return _cache_put(key, data.get("properties") or {})
+
 @mcp.tool()
-def search_drugs(query: str, limit: int = 5) -> str:
+async def search_drugs(query: str, limit: int = 5) -> str:
     """
     Search RxNorm for drug concepts by brand or generic name.
     Args:
@@ -28,38 +144,22 @@ def search_drugs(query: str, limit: int = 5) -> str:
     Returns:
       Pretty-printed JSON string: {"query": "...", "results": [ {...}, ... ]}
     """
-    q = (query or "").strip()
+    # RxNorm name search is case-insensitive, so case variants share one cache entry
+    q = (query or "").strip().lower()
     if not q:
-        return json.dumps({"error": "query is required"}, indent=2)
+        return _to_json({"error": "query is required"})
 
     lim = _clip_limit(limit)
-
-    # RxNorm "drugs" endpoint groups results in conceptGroup[].conceptProperties[]
-    url = "https://rxnav.nlm.nih.gov/REST/drugs.json"
     try:
-        r = requests.get(url, params={"name": q}, timeout=20)
-        r.raise_for_status()
-        data = r.json() or {}
-    except requests.RequestException as e:
-        return json.dumps({"error": f"HTTP error contacting RxNorm: {e}"}, indent=2)
-
-    results: List[Dict[str, Any]] = []
-    drug_group = (data.get("drugGroup") or {})
-    for grp in (drug_group.get("conceptGroup") or []):
-        for c in (grp.get("conceptProperties") or []):
-            results.append({
-                "rxcui": c.get("rxcui"),
-                "name": c.get("name"),
-                "synonym": c.get("synonym"),
-                "tty": c.get("tty"),
-            })
-
-    return json.dumps({"query": q, "results": results[:lim]}, indent=2)
+        return await _search_drugs_cached(q, lim)
+    except RXNORM_ERRORS as e:
+        return _to_json(_rxnorm_error(e))
 
 @mcp.tool()
-def get_drug_properties(rxcui: str) -> str:
+async def get_drug_properties(rxcui: str) -> str:
     """
     Fetch RxNorm properties for a given RXCUI.
+    For several drugs at once, use get_drug_properties_batch instead.
     Args:
       rxcui: RxNorm Concept Unique Identifier (string or int)
     Returns:
@@ -67,18 +167,75 @@ def get_drug_properties(rxcui: str) -> str:
     """
     rx = str(rxcui or "").strip()
     if not rx:
-        return json.dumps({"error": "rxcui is required"}, indent=2)
+        return _to_json({"error": "rxcui is required"})
 
-    url = f"https://rxnav.nlm.nih.gov/REST/rxcui/{rx}/properties.json"
     try:
-        r = requests.get(url, timeout=20)
-        r.raise_for_status()
-        data = r.json() or {}
-    except requests.RequestException as e:
-        return json.dumps({"error": f"HTTP error contacting RxNorm: {e}"}, indent=2)
-
-    props = (data.get("properties") or {})
-    return json.dumps({"rxcui": rx, "properties": props}, indent=2)
+        return _to_json({"rxcui": rx, "properties": await _get_properties_cached(rx)})
+    except RXNORM_ERRORS as e:
+        return _to_json(_rxnorm_error(e))
+
+MAX_BATCH_RXCUIS = 20
+
+@mcp.tool()
+async def get_drug_properties_batch(rxcuis: List[str]) -> str:
+    """
+    Fetch RxNorm properties for several RXCUIs in one call (looked up concurrently).
+    Prefer this over repeated get_drug_properties calls when comparing or listing drugs.
+    Args:
+      rxcuis: list of RxNorm Concept Unique Identifiers (duplicates ignored, max 20)
+    Returns:
+      Pretty-printed JSON string: {"results": {"<rxcui>": {properties} | {"error": "..."}, ...}}
+    """
+    rxs = list(dict.fromkeys(str(rx or "").strip() for rx in rxcuis or []))
+    rxs = [rx for rx in rxs if rx][:MAX_BATCH_RXCUIS]
+    if not rxs:
+        return _to_json({"error": "rxcuis is required"})
+
+    fetched = await asyncio.gather(*(_get_properties_cached(rx) for rx in rxs), return_exceptions=True)
+    results: Dict[str, Any] = {}
+    for rx, props in zip(rxs, fetched):
+        if isinstance(props, RXNORM_ERRORS):
+            results[rx] = _rxnorm_error(props)
+        elif isinstance(props, BaseException):
+            raise props
+        else:
+            results[rx] = props
+    return _to_json({"results": results})
+
+_BATCHABLE = {"search_drugs", "get_drug_properties", "get_drug_properties_batch"}
+
+def _content_text(content: Any) -> str:
+    """Text of a FastMCP.call_tool result (newer versions return (content, structured))."""
+    if isinstance(content, tuple):
+        content = content[0]
+    return "".join(getattr(c, "text", "") for c in content or [])
+
+async def _run_op(op: Dict[str, Any]) -> Dict[str, Any]:
+    name = (op or {}).get("tool")
+    if not isinstance(name, str) or name not in _BATCHABLE:
+        result = _to_json({"error": f"unknown tool: {name}"})
+    else:
+        # Go through FastMCP so args get the same validation as a direct tool call;
+        # a bad op becomes that op's error instead of junk lookups or a failed batch
+        try:
+            result = _content_text(await mcp.call_tool(name, (op or {}).get("args") or {}))
+        except Exception as e:  # ToolError: invalid arguments or the tool raised
+            result = _to_json({"error": str(e)})
+    return {"tool": name, "result": result}
+
+@mcp.tool()
+async def batch_execute(ops: List[Dict[str, Any]]) -> str:
+    """
+    Run several of this server's tools in a single request (used by the MCP host to
+    fold multiple tool calls into one round-trip; not meant for the model).
+    Args:
+      ops: [{"tool": "search_drugs" | "get_drug_properties" | "get_drug_properties_batch", "args": {...}}, ...]
+    Returns:
+      JSON list, one {"tool": ..., "result": <that tool's JSON string>} per op, in order.
+    """
+    # Ops run concurrently; gather keeps their order
+    out = await asyncio.gather(*(_run_op(op) for op in ops or []))
+    return orjson.dumps(out).decode()
 
 if __name__ == "__main__":
     # Same transport your research server uses.